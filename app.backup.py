@@ -1,15 +1,30 @@
+import hashlib
+import hmac
 import os
-from datetime import datetime, timedelta
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
 
-from flask import Flask, request, render_template, redirect, url_for, flash
+from flask import Flask, request, render_template, redirect, url_for, flash, session, abort
+from cachetools import TTLCache
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, event, func, select
+from sqlalchemy import delete as sql_delete
 from flask_login import (
     LoginManager, UserMixin, login_user, logout_user,
     login_required, current_user
 )
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 import stripe
 
+from db_patches import run_db_patches
+
 # --- Load .env if present ---
 try:
     from dotenv import load_dotenv
@@ -19,28 +34,136 @@ except Exception:
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key')
+# Render/Heroku sit one proxy hop in front; trust its X-Forwarded-For for the client IP
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 
 # --- Database: store under the "instance" folder ---
 os.makedirs(app.instance_path, exist_ok=True)
 default_sqlite_path = 'sqlite:///' + os.path.join(app.instance_path, 'subscriptions.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', default_sqlite_path)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # Keep warm server connections, one per gunicorn thread; SQLite keeps the default QueuePool
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.getenv('GUNICORN_THREADS', '4')),
+        'max_overflow': 0,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
 db = SQLAlchemy(app)
 
+def _set_sqlite_pragma(dbapi_conn, _record):
+    # WAL lets readers proceed while a write is in flight; NORMAL syncs once per checkpoint
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.execute('PRAGMA mmap_size=268435456')
+    cur.execute('PRAGMA cache_size=-20000')
+    cur.close()
+
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # Only this app's engine; other engines in the process (e.g. a result backend) are left alone
+    with app.app_context():
+        event.listen(db.engine, 'connect', _set_sqlite_pragma)
+
 # --- Login manager ---
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+# --- Rate limiting (in-memory per worker unless RATELIMIT_STORAGE_URI points at Redis) ---
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    storage_uri=os.getenv('RATELIMIT_STORAGE_URI', 'memory://'),
+)
+
+# --- Password checks ---
+# Argon2id tuned for roughly 50ms per hash; legacy Werkzeug PBKDF2 hashes still
+# verify and are upgraded on the next successful login
+_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
+def _hash_password(pw: str) -> str:
+    return _hasher.hash(pw)
+
+def _verify_password(stored_hash: str, pw: str) -> bool:
+    if stored_hash.startswith('$argon2'):
+        try:
+            return _hasher.verify(stored_hash, pw)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(stored_hash, pw)
+
+def _needs_rehash(stored_hash: str) -> bool:
+    return not stored_hash.startswith('$argon2') or _hasher.check_needs_rehash(stored_hash)
+
+
+# Recently rejected (stored hash, HMAC(attempt)) pairs, so a retried wrong password
+# is turned away without hashing it again
+_REJECTED_MAX = 4096
+_rejected = OrderedDict()
+_rejected_lock = threading.Lock()
+# Per-process key so a memory dump doesn't hold crackable digests of wrong passwords
+_REJECTED_KEY = secrets.token_bytes(32)
+
+def _password_matches(stored_hash: str, pw: str) -> bool:
+    key = (stored_hash, hmac.new(_REJECTED_KEY, pw.encode(), hashlib.sha256).digest())
+    with _rejected_lock:
+        if key in _rejected:
+            _rejected.move_to_end(key)
+            return False
+    if _verify_password(stored_hash, pw):
+        return True
+    with _rejected_lock:
+        _rejected[key] = None
+        if len(_rejected) > _REJECTED_MAX:
+            _rejected.popitem(last=False)
+    return False
+
 # --- Stripe config (test mode keys live in .env) ---
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+# Cap each Stripe call at 5s (library default: 80s) so a slow API can't pin a worker
+# thread. Timeouts are retried; Stripe tags every POST with an idempotency key, so a
+# retried Session.create can't open a second checkout. A checkout creation that still
+# fails happens before any charge and just shows the "Stripe error" flash.
+stripe.default_http_client = stripe.RequestsClient(timeout=5)
+stripe.max_network_retries = 2
 STRIPE_PRICE_ID = os.getenv('STRIPE_PRICE_ID')
 
+# --- Background jobs (opt-in: CHECKOUT_VERIFY_ASYNC=1, Celery installed, REDIS_URL set) ---
+# A worker has to import this module to register the task
+# (`celery -A <module>.celery worker -Q stripe`), so the async path is never enabled
+# when the file runs as __main__. A REDIS_URL on its own (e.g. from a Redis add-on)
+# doesn't switch it on; without a worker, verifications would just pile up.
+try:
+    from celery import Celery
+    from kombu.exceptions import OperationalError as BrokerError
+except ImportError:
+    Celery = None
+
+REDIS_URL = os.getenv('REDIS_URL')
+ASYNC_CHECKOUT_VERIFY = os.getenv('CHECKOUT_VERIFY_ASYNC') == '1' and __name__ != '__main__'
+celery = Celery('saver', broker=REDIS_URL) if Celery and REDIS_URL and ASYNC_CHECKOUT_VERIFY else None
+if celery:
+    # Stripe calls get their own queue so they don't contend with other jobs
+    celery.conf.task_routes = {'saver.verify_checkout': {'queue': 'stripe'}}
+    # Fail fast when the broker is down so the view can verify inline instead
+    celery.conf.task_publish_retry = False
+
 # --- Models ---
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
     is_premium = db.Column(db.Boolean, default=False)
+    stripe_customer_id = db.Column(db.String(64), index=True, nullable=True)
+
+    subscriptions = db.relationship('Subscription', back_populates='user', lazy='select')
+
+    __table_args__ = (
+        # Case-insensitive uniqueness; also serves the lower(email) login/signup lookups
+        db.Index('ix_user_email_lower', func.lower(email), unique=True),
+    )
 
 class Subscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -49,19 +172,28 @@ class Subscription(db.Model):
     renewal_date = db.Column(db.Date, nullable=False)
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    user = db.relationship('User', backref=db.backref('subscriptions', lazy=True))
+    user = db.relationship('User', back_populates='subscriptions')
 
-with app.app_context():
-    db.create_all()
+    __table_args__ = (
+        # Covers the dashboard's per-user ORDER BY renewal_date
+        db.Index('ix_sub_user_renewal', 'user_id', 'renewal_date'),
+    )
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+@app.cli.command('init-db')
+def init_db():
+    """Create missing tables and apply db_patches (run once per deploy, not per worker)."""
+    db.create_all()
+    run_db_patches(db)
 
 FREE_LIMIT = 5  # free-tier limit
 
 # --- Auth routes ---
 @app.route('/signup', methods=['GET', 'POST'])
+@limiter.limit('5 per minute', methods=['POST'])
 def signup():
     if request.method == 'POST':
         email = (request.form.get('email') or '').strip().lower()
@@ -69,10 +201,10 @@ def signup():
         if not email or not password:
             flash("Email and password are required", "warning")
             return redirect(url_for('signup'))
-        if User.query.filter_by(email=email).first():
+        if db.session.scalar(select(User.id).where(func.lower(User.email) == email)) is not None:
             flash("Email already registered — try logging in", "warning")
             return redirect(url_for('login'))
-        user = User(email=email, password_hash=generate_password_hash(password))
+        user = User(email=email, password_hash=_hash_password(password))
         db.session.add(user)
         db.session.commit()
         login_user(user)
@@ -81,14 +213,18 @@ def signup():
     return render_template('signup.html')
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('10 per minute', methods=['POST'])
 def login():
     if request.method == 'POST':
         email = (request.form.get('email') or '').strip().lower()
         password = (request.form.get('password') or '').strip()
-        user = User.query.filter_by(email=email).first()
-        if not user or not check_password_hash(user.password_hash, password):
+        user = db.session.scalar(select(User).where(func.lower(User.email) == email))
+        if not user or not _password_matches(user.password_hash, password):
             flash("Invalid email or password", "warning")
             return redirect(url_for('login'))
+        if _needs_rehash(user.password_hash):
+            user.password_hash = _hash_password(password)
+            db.session.commit()
         login_user(user)
         flash("Logged in", "success")
         return redirect(url_for('index'))
@@ -101,60 +237,111 @@ def logout():
     flash("Logged out", "info")
     return redirect(url_for('login'))
 
+# --- Forms ---
+class BadForm(ValueError):
+    """A submitted form failed validation; the message is meant for flash()."""
+
+def _parse_subscription_form(form):
+    """Return (name, price, renewal_date) from the add-subscription form or raise BadForm."""
+    name = form.get('name', '').strip()
+    price = form.get('price', '').strip()
+    date_str = form.get('renewal_date', '').strip()
+    if not (name and price and date_str):
+        raise BadForm("Please fill in all fields")
+    try:
+        price_val = float(price)
+    except ValueError:
+        raise BadForm("Price must be a number") from None
+    try:
+        return name, price_val, date.fromisoformat(date_str)
+    except ValueError:
+        raise BadForm("Date must be in YYYY-MM-DD format") from None
+
 # --- Dashboard ---
+# Short-lived per-worker cache of the dashboard context; the key carries a revision
+# counter from the session cookie that add/delete bump, so other workers miss too
+_dashboard_cache = TTLCache(maxsize=10_000, ttl=5)
+_dashboard_lock = threading.Lock()
+
+def _dashboard_key():
+    return current_user.id, session.get('dash_rev', 0)
+
+def _invalidate_dashboard():
+    with _dashboard_lock:
+        _dashboard_cache.pop(_dashboard_key(), None)
+    session['dash_rev'] = session.get('dash_rev', 0) + 1
+
+def _build_dashboard(user_id):
+    """Return (subscriptions, total_cost, upcoming_names) for the user's dashboard."""
+    today = date.today()
+    week_ahead = today + timedelta(days=7)
+    # One round-trip: the rows, an "upcoming" flag and the user's total (window SUM)
+    stmt = (
+        select(
+            Subscription,
+            case((Subscription.renewal_date.between(today, week_ahead), 1), else_=0).label('soon'),
+            func.sum(Subscription.price).over().label('total'),
+        )
+        .where(Subscription.user_id == user_id)
+        .order_by(Subscription.renewal_date.asc())
+    )
+    # Single pass over the result; every row carries the same window total
+    subs, total_cost, upcoming_names = [], 0.0, []
+    for row in db.session.execute(stmt):
+        subs.append(row.Subscription)
+        total_cost = row.total
+        if row.soon:
+            upcoming_names.append(row.Subscription.name)
+    return subs, total_cost, upcoming_names
+
 @app.route('/', methods=['GET', 'POST'])
 @login_required
 def index():
     if request.method == 'POST':
-        name = (request.form.get('name') or '').strip()
-        price = (request.form.get('price') or '').strip()
-        date_str = (request.form.get('renewal_date') or '').strip()
-
-        if not (name and price and date_str):
-            flash("Please fill in all fields", "warning")
-            return redirect(url_for('index'))
-
-        try:
-            price_val = float(price)
-        except ValueError:
-            flash("Price must be a number", "warning")
-            return redirect(url_for('index'))
-
         try:
-            rdate = datetime.strptime(date_str, "%Y-%m-%d").date()
-        except ValueError:
-            flash("Date must be in YYYY-MM-DD format", "warning")
+            name, price_val, rdate = _parse_subscription_form(request.form)
+        except BadForm as e:
+            flash(str(e), "warning")
             return redirect(url_for('index'))
 
         # enforce free-tier limit for non-premium users
-        current_count = Subscription.query.filter_by(user_id=current_user.id).count()
+        current_count = db.session.scalar(
+            select(func.count(Subscription.id)).where(Subscription.user_id == current_user.id)
+        )
         if not current_user.is_premium and current_count >= FREE_LIMIT:
             flash("Free limit reached (5). Upgrade to Premium for unlimited subscriptions.", "warning")
             return redirect(url_for('index'))
 
         db.session.add(Subscription(name=name, price=price_val, renewal_date=rdate, user_id=current_user.id))
         db.session.commit()
+        _invalidate_dashboard()
         flash(f"Added subscription: {name}", "success")
         return redirect(url_for('index'))
 
-    subs = Subscription.query.filter_by(user_id=current_user.id).order_by(Subscription.renewal_date.asc()).all()
-    total_cost = sum(s.price for s in subs)
-
-    today = datetime.today().date()
-    week_ahead = today + timedelta(days=7)
-    upcoming_names = [s.name for s in subs if today <= s.renewal_date <= week_ahead]
+    key = _dashboard_key()
+    with _dashboard_lock:
+        ctx = _dashboard_cache.get(key)
+    if ctx is None:
+        ctx = _build_dashboard(current_user.id)
+        with _dashboard_lock:
+            _dashboard_cache[key] = ctx
+    subs, total_cost, upcoming_names = ctx
 
     return render_template('index.html', subscriptions=subs, total_cost=total_cost, upcoming=upcoming_names)
 
 @app.route('/delete/<int:sub_id>', methods=['POST'])
 @login_required
 def delete_sub(sub_id):
-    sub = Subscription.query.get_or_404(sub_id)
-    if sub.user_id != current_user.id:
-        flash("Not allowed", "warning")
-        return redirect(url_for('index'))
-    db.session.delete(sub)
+    # Ownership check and delete in one statement; someone else's id is a 404
+    deleted_id = db.session.execute(
+        sql_delete(Subscription)
+        .where(Subscription.id == sub_id, Subscription.user_id == current_user.id)
+        .returning(Subscription.id)
+    ).scalar()
+    if deleted_id is None:
+        abort(404)
     db.session.commit()
+    _invalidate_dashboard()
     flash("Subscription deleted", "info")
     return redirect(url_for('index'))
 
@@ -175,6 +362,12 @@ def create_checkout_session():
         flash("Payment not configured. Missing STRIPE keys.", "warning")
         return redirect(url_for('upgrade'))
 
+    # Reuse the Stripe customer from a previous checkout instead of creating a new one
+    if current_user.stripe_customer_id:
+        customer_args = {"customer": current_user.stripe_customer_id}
+    else:
+        customer_args = {"customer_email": current_user.email}
+
     try:
         session = stripe.checkout.Session.create(
             mode="subscription",
@@ -182,13 +375,41 @@ def create_checkout_session():
             line_items=[{"price": price_id, "quantity": 1}],
             success_url=url_for('upgrade_success', _external=True) + "?session_id={CHECKOUT_SESSION_ID}",
             cancel_url=url_for('upgrade', _external=True),
-            customer_email=current_user.email
+            client_reference_id=str(current_user.id),
+            **customer_args
         )
         return redirect(session.url, code=303)
     except Exception as e:
         flash(f"Stripe error: {e}", "warning")
         return redirect(url_for('upgrade'))
 
+def verify_checkout(session_id, user_id):
+    """Mark the user Premium if the Checkout Session is theirs and paid; returns whether it was."""
+    cs = stripe.checkout.Session.retrieve(session_id)
+    # A session id from the query string may belong to someone else; never copy it across
+    if cs.get("client_reference_id") != str(user_id):
+        return False
+    if cs.get("payment_status") != "paid":
+        return False
+    user = db.session.get(User, user_id)
+    user.is_premium = True
+    if cs.get("customer"):
+        user.stripe_customer_id = cs["customer"]
+    db.session.commit()
+    return True
+
+if celery:
+    # Retry transient Stripe failures (5s client timeout) with exponential backoff
+    @celery.task(
+        name='saver.verify_checkout',
+        autoretry_for=(stripe.error.StripeError,),
+        retry_backoff=True,
+        max_retries=8,
+    )
+    def verify_checkout_task(session_id, user_id):
+        with app.app_context():
+            verify_checkout(session_id, user_id)
+
 @app.route('/upgrade/success', methods=['GET'])
 @login_required
 def upgrade_success():
@@ -196,11 +417,19 @@ def upgrade_success():
     if not session_id:
         flash("Missing session id.", "warning")
         return redirect(url_for('index'))
+
+    if celery:
+        # Don't hold the web worker on Stripe's API; the worker flips is_premium
+        try:
+            verify_checkout_task.delay(session_id, current_user.id)
+        except BrokerError:
+            app.logger.warning("Celery broker unavailable; verifying checkout inline")
+        else:
+            flash("Verifying your payment… Premium will be enabled once Stripe confirms it.", "info")
+            return redirect(url_for('index'), code=303)
+
     try:
-        cs = stripe.checkout.Session.retrieve(session_id)
-        if cs.get("payment_status") == "paid":
-            current_user.is_premium = True
-            db.session.commit()
+        if verify_checkout(session_id, current_user.id):
             flash("✅ Upgrade successful! Your account is now Premium.", "success")
         else:
             flash("Payment not completed yet.", "warning")
@@ -209,4 +438,12 @@ def upgrade_success():
     return redirect(url_for('index'))
 
 if __name__ == "__main__":
+    # Dev server only. The Procfile and gunicorn.conf.py serve app.py (app:app); this
+    # file can't be imported as a module ("app.backup"), so it has no gunicorn entry point.
+    if os.getenv('FLASK_ENV') != 'development':
+        raise SystemExit("Set FLASK_ENV=development to use the dev server "
+                         "(production serves app.py: gunicorn -c gunicorn.conf.py app:app)")
+    with app.app_context():
+        db.create_all()
+        run_db_patches(db)
     app.run(debug=True)
@@ -1,13 +1,28 @@
+import hashlib
+import hmac
 import os
-from datetime import datetime, timedelta
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 
-from flask import Flask, request, render_template, redirect, url_for, flash
+from flask import Flask, request, render_template, redirect, url_for, flash, session, abort
+from cachetools import TTLCache
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, event, func, select
+from sqlalchemy import delete as sql_delete
 from flask_login import (
     LoginManager, UserMixin, login_user, login_required,
     logout_user, current_user
 )
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+from db_patches import run_db_patches
 
 # Optional: load .env locally (Render/Heroku will inject env vars)
 try:
@@ -18,6 +33,8 @@ except Exception:
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key")
+# Render/Heroku sit one proxy hop in front; trust its X-Forwarded-For for the client IP
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 
 # --- Database setup ---
 db_url = os.getenv("DATABASE_URL")
@@ -28,13 +45,95 @@ if not db_url:
 db_url = db_url.replace("postgres://", "postgresql://")
 app.config["SQLALCHEMY_DATABASE_URI"] = db_url
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+if not db_url.startswith("sqlite"):
+    # Keep warm Postgres connections instead of a fresh TCP/TLS handshake per checkout.
+    # SQLite keeps SQLAlchemy's default QueuePool, which already reuses file connections.
+    # One connection per gunicorn thread, so workers x threads bounds the total.
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.getenv("GUNICORN_THREADS", "4")),
+        "max_overflow": 0,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
 
 db = SQLAlchemy(app)
 
+
+def _set_sqlite_pragma(dbapi_conn, _record):
+    # WAL lets readers proceed while a write is in flight; NORMAL syncs once per checkpoint
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA cache_size=-20000")
+    cur.close()
+
+
+if db_url.startswith("sqlite"):
+    # Only this app's engine; other engines in the process (e.g. a result backend) are left alone
+    with app.app_context():
+        event.listen(db.engine, "connect", _set_sqlite_pragma)
+
 # --- Auth setup ---
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
+# --- Rate limiting (in-memory per worker unless RATELIMIT_STORAGE_URI points at Redis) ---
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    storage_uri=os.getenv("RATELIMIT_STORAGE_URI", "memory://"),
+)
+
+
+# --- Password checks ---
+# Argon2id tuned for roughly 50ms per hash; legacy Werkzeug PBKDF2 hashes still
+# verify and are upgraded on the next successful login
+_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
+
+def _hash_password(pw: str) -> str:
+    return _hasher.hash(pw)
+
+
+def _verify_password(stored_hash: str, pw: str) -> bool:
+    if stored_hash.startswith("$argon2"):
+        try:
+            return _hasher.verify(stored_hash, pw)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(stored_hash, pw)
+
+
+def _needs_rehash(stored_hash: str) -> bool:
+    return not stored_hash.startswith("$argon2") or _hasher.check_needs_rehash(stored_hash)
+
+
+# Recently rejected (stored hash, HMAC(attempt)) pairs, so a retried wrong password
+# is turned away without hashing it again. Keying on the stored hash means a
+# changed password never hits a stale entry.
+_REJECTED_MAX = 4096
+_rejected = OrderedDict()
+_rejected_lock = threading.Lock()
+# Per-process key so a memory dump doesn't hold crackable digests of wrong passwords
+_REJECTED_KEY = secrets.token_bytes(32)
+
+
+def _password_matches(stored_hash: str, pw: str) -> bool:
+    key = (stored_hash, hmac.new(_REJECTED_KEY, pw.encode(), hashlib.sha256).digest())
+    with _rejected_lock:
+        if key in _rejected:
+            _rejected.move_to_end(key)
+            return False
+    if _verify_password(stored_hash, pw):
+        return True
+    with _rejected_lock:
+        _rejected[key] = None
+        if len(_rejected) > _REJECTED_MAX:
+            _rejected.popitem(last=False)
+    return False
+
 
 # --- Models ---
 class User(UserMixin, db.Model):
@@ -46,11 +145,21 @@ class User(UserMixin, db.Model):
     # (Legacy) kept for backward compatibility; ignored in UI/logic now
     premium = db.Column(db.Boolean, default=True)
 
+    subscriptions = db.relationship("Subscription", back_populates="user", lazy="select")
+
+    __table_args__ = (
+        # Case-insensitive uniqueness; also serves the lower(email) login/signup lookups
+        db.Index("ix_user_email_lower", func.lower(email), unique=True),
+    )
+
     def set_password(self, pw: str):
-        self.password_hash = generate_password_hash(pw)
+        self.password_hash = _hash_password(pw)
 
     def check_password(self, pw: str) -> bool:
-        return check_password_hash(self.password_hash, pw)
+        return _password_matches(self.password_hash, pw)
+
+    def password_needs_rehash(self) -> bool:
+        return _needs_rehash(self.password_hash)
 
 
 class Subscription(db.Model):
@@ -60,12 +169,92 @@ class Subscription(db.Model):
     renewal_date = db.Column(db.Date, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 
-    user = db.relationship(User, backref=db.backref("subscriptions", lazy=True))
+    user = db.relationship(User, back_populates="subscriptions")
+
+    __table_args__ = (
+        # Covers the per-user dashboard query and its renewal-date filtering
+        db.Index("ix_sub_user_renewal", "user_id", "renewal_date"),
+    )
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+
+@app.cli.command("init-db")
+def init_db():
+    """Create missing tables and apply db_patches (run once per deploy, not per worker)."""
+    db.create_all()
+    run_db_patches(db)
+
+
+# --- Forms ---
+class BadForm(ValueError):
+    """A submitted form failed validation; the message is meant for flash()."""
+
+
+def _parse_subscription_form(form):
+    """Return (name, price, renewal_date) from the add-subscription form or raise BadForm."""
+    name = form.get("name", "").strip()
+    price_raw = form.get("price", "").strip()
+    if not name or not price_raw:
+        raise BadForm("Please fill in name and price.")
+    try:
+        price = float(price_raw)
+    except ValueError:
+        raise BadForm("Price must be a number.") from None
+
+    date_str = form.get("date", "").strip()
+    if not date_str:
+        return name, price, None
+    try:
+        return name, price, date.fromisoformat(date_str)
+    except ValueError:
+        raise BadForm("Date must be in YYYY-MM-DD format.") from None
+
+
+# --- Dashboard ---
+# Short-lived per-worker cache of the dashboard context. The key carries a revision
+# counter kept in the user's session cookie and bumped on every add/delete, so the
+# redirect after a write misses the cache on whichever worker serves it.
+_dashboard_cache = TTLCache(maxsize=10_000, ttl=5)
+_dashboard_lock = threading.Lock()
+
+
+def _dashboard_key():
+    return current_user.id, session.get("dash_rev", 0)
+
+
+def _invalidate_dashboard():
+    with _dashboard_lock:
+        _dashboard_cache.pop(_dashboard_key(), None)
+    session["dash_rev"] = session.get("dash_rev", 0) + 1
+
+
+def _build_dashboard(user_id):
+    """Return (subscriptions, total, due_soon_ids) for the user's dashboard."""
+    # “Due soon” flag = within next 7 days
+    today = datetime.utcnow().date()
+    week_ahead = today + timedelta(days=7)
+    # One round-trip: the rows, a due-soon flag and the user's total (window SUM)
+    stmt = (
+        select(
+            Subscription,
+            case((Subscription.renewal_date.between(today, week_ahead), 1), else_=0).label("soon"),
+            func.sum(Subscription.price).over().label("total"),
+        )
+        .where(Subscription.user_id == user_id)
+        .order_by(Subscription.name.asc())
+    )
+    # Single pass over the result; every row carries the same window total
+    subs, total, due_soon_ids = [], 0.0, set()
+    for row in db.session.execute(stmt):
+        subs.append(row.Subscription)
+        total = row.total
+        if row.soon:
+            due_soon_ids.add(row.Subscription.id)
+    return subs, total, due_soon_ids
 
 
 # --- Routes ---
@@ -74,56 +263,49 @@ def load_user(user_id):
 def index():
     msg = None
     if request.method == "POST":
-        name = (request.form.get("name") or "").strip()
-        price_raw = (request.form.get("price") or "").strip()
-        date_str = (request.form.get("date") or "").strip()
-
-        if not name or not price_raw:
-            flash("Please fill in name and price.", "warning")
-            return redirect(url_for("index"))
-
         try:
-            price = float(price_raw)
-        except ValueError:
-            flash("Price must be a number.", "warning")
+            name, price, renewal_date = _parse_subscription_form(request.form)
+        except BadForm as e:
+            flash(str(e), "warning")
             return redirect(url_for("index"))
 
-        renewal_date = None
-        if date_str:
-            try:
-                renewal_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            except ValueError:
-                flash("Date must be in YYYY-MM-DD format.", "warning")
-                return redirect(url_for("index"))
-
         sub = Subscription(name=name, price=price, renewal_date=renewal_date, user_id=current_user.id)
         db.session.add(sub)
         db.session.commit()
+        _invalidate_dashboard()
         flash(f"Added subscription: {name}", "success")
         return redirect(url_for("index"))
 
-    subs = Subscription.query.filter_by(user_id=current_user.id).order_by(Subscription.name.asc()).all()
-    total = sum(s.price for s in subs)
-    # “Due soon” flag = within next 7 days
-    today = datetime.utcnow().date()
-    due_soon_ids = {
-        s.id for s in subs
-        if s.renewal_date and 0 <= (s.renewal_date - today).days <= 7
-    }
+    key = _dashboard_key()
+    with _dashboard_lock:
+        ctx = _dashboard_cache.get(key)
+    if ctx is None:
+        ctx = _build_dashboard(current_user.id)
+        with _dashboard_lock:
+            _dashboard_cache[key] = ctx
+    subs, total, due_soon_ids = ctx
     return render_template("index.html", subscriptions=subs, total=total, due_soon_ids=due_soon_ids)
 
 
 @app.route("/delete/<int:sub_id>", methods=["POST", "GET"])
 @login_required
 def delete(sub_id):
-    sub = Subscription.query.filter_by(id=sub_id, user_id=current_user.id).first_or_404()
-    db.session.delete(sub)
+    # Ownership check and delete in one statement; no SELECT round-trip first
+    deleted_id = db.session.execute(
+        sql_delete(Subscription)
+        .where(Subscription.id == sub_id, Subscription.user_id == current_user.id)
+        .returning(Subscription.id)
+    ).scalar()
+    if deleted_id is None:
+        abort(404)
     db.session.commit()
+    _invalidate_dashboard()
     flash("Subscription deleted.", "info")
     return redirect(url_for("index"))
 
 
 @app.route("/signup", methods=["GET", "POST"])
+@limiter.limit("5 per minute", methods=["POST"])
 def signup():
     if request.method == "POST":
         email = (request.form.get("email") or "").strip().lower()
@@ -133,7 +315,7 @@ def signup():
             flash("Email and password are required.", "warning")
             return redirect(url_for("signup"))
 
-        if User.query.filter_by(email=email).first():
+        if db.session.scalar(select(User.id).where(func.lower(User.email) == email)) is not None:
             flash("Email already registered — try logging in.", "warning")
             return redirect(url_for("login"))
 
@@ -149,13 +331,17 @@ def signup():
 
 
 @app.route("/login", methods=["GET", "POST"])
+@limiter.limit("10 per minute", methods=["POST"])
 def login():
     if request.method == "POST":
         email = (request.form.get("email") or "").strip().lower()
         password = (request.form.get("password") or "").strip()
 
-        user = User.query.filter_by(email=email).first()
+        user = db.session.scalar(select(User).where(func.lower(User.email) == email))
         if user and user.check_password(password):
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
             login_user(user)
             flash("Logged in", "info")
             return redirect(url_for("index"))
@@ -175,6 +361,11 @@ def logout():
 
 
 if __name__ == "__main__":
+    # Local development only; production runs `gunicorn -c gunicorn.conf.py app:app`
+    if os.getenv("FLASK_ENV") != "development":
+        raise SystemExit("Set FLASK_ENV=development to use the dev server, "
+                         "or run: gunicorn -c gunicorn.conf.py app:app")
     with app.app_context():
         db.create_all()
+        run_db_patches(db)
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)), debug=True)
@@ -1,17 +1,50 @@
 # db_patches.py
-from sqlalchemy import text
+from sqlalchemy import inspect, text
+
+
+def _add_column_if_missing(conn, table, column, ddl):
+    """
+    ALTER TABLE ... ADD COLUMN unless the column is already there. Works on SQLite,
+    which has no ADD COLUMN IF NOT EXISTS (the inspector reads PRAGMA table_info).
+    """
+    if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
 
 def run_db_patches(db):
     """
-    Idempotent DB patches that can run safely on each deploy.
+    Idempotent DB patches that can run safely on each deploy (Postgres and SQLite).
     """
+    # Both apps share these patches; column patches only apply when the calling
+    # app's model declares the column, so one app's schema never leaks into the other
+    user_columns = db.metadata.tables["user"].c
+
     with db.engine.begin() as conn:
-        # Add created_at if it's missing (Postgres safe)
-        conn.execute(
-            text('ALTER TABLE "user" '
-                 'ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()')
-        )
+        if conn.dialect.name == "postgresql" and "created_at" in user_columns:
+            # Add created_at if it's missing (Postgres safe)
+            conn.execute(
+                text('ALTER TABLE "user" '
+                     'ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()')
+            )
+        if "stripe_customer_id" in user_columns:
+            # Stripe customer id, stored after the first successful checkout
+            _add_column_if_missing(conn, "user", "stripe_customer_id", "VARCHAR(64)")
+            conn.execute(
+                text('CREATE INDEX IF NOT EXISTS ix_user_stripe_customer_id ON "user"(stripe_customer_id)')
+            )
         # Optional: make sure email is indexed/unique (no-op if it already exists)
         conn.execute(
             text('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email ON "user"(email)')
         )
+        # Per-user subscription lookups (dashboard, free-tier count). The composite index's
+        # leading user_id column covers plain user_id lookups, so a separate one is dropped.
+        conn.execute(
+            text('DROP INDEX IF EXISTS ix_subscription_user_id')
+        )
+        conn.execute(
+            text('CREATE INDEX IF NOT EXISTS ix_sub_user_renewal ON subscription(user_id, renewal_date)')
+        )
+        # Case-insensitive email uniqueness, even for rows inserted outside the app
+        conn.execute(
+            text('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email_lower ON "user"(lower(email))')
+        )
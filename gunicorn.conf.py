@@ -0,0 +1,27 @@
+# gunicorn.conf.py
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# Kept small on purpose: cpu_count() reports host CPUs inside containers, and every
+# thread may hold a DB connection and a 64 MiB Argon2 hash at the same time.
+# Budget: workers x threads Postgres connections (the app sizes its pool to threads).
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+
+# Import the app once in the master so workers share its pages copy-on-write
+preload_app = True
+
+# Recycle workers periodically to cap slow memory growth
+max_requests = 2000
+max_requests_jitter = 200
+
+
+def post_fork(server, worker):
+    """
+    Drop DB connections inherited from the master so each worker opens its own.
+    """
+    from app import app, db
+
+    with app.app_context():
+        db.engine.dispose(close=False)